@@ -1,8 +1,20 @@
 import os
-from flask import Flask, render_template, request, redirect, url_for
+import re
+import functools
+import atexit
+import queue
+import socket
+import threading
+import time
+import click
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, render_template, request, redirect, url_for, g, abort, has_app_context, jsonify
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
 from flask_migrate import Migrate
-from datetime import datetime
+from alembic import command as alembic_command
+from datetime import datetime, timedelta
 import pytz  # タイムゾーンのサポートを追加
 
 
@@ -10,7 +22,54 @@ app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///materials.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
-db = SQLAlchemy(app)
+# 使用履歴の書き込みモード
+# 'sync': リクエストごとにコミット / 'batched': キュー経由でまとめて書き込む
+app.config['USAGE_DURABILITY'] = os.environ.get('USAGE_DURABILITY', 'sync')
+app.config['USAGE_BATCH_SIZE'] = 100  # まとめて書き込む最大件数
+app.config['USAGE_FLUSH_INTERVAL_MS'] = 500  # 書き込みまでの最大待ち時間
+app.config['USAGE_QUEUE_MAXSIZE'] = 10000  # キューに溜められる最大件数
+
+# 使用履歴のアーカイブ設定（0 の場合は定期アーカイブを行わない）
+# 定期アーカイブはリクエストを処理するプロセスで最初のリクエスト時に 1 度だけ開始する。
+# 複数のワーカープロセスで動かす場合は 0 のままにし、cron などから flask archive-usage を実行する
+app.config['USAGE_ARCHIVE_DAYS'] = int(os.environ.get('USAGE_ARCHIVE_DAYS', 0))
+app.config['USAGE_ARCHIVE_INTERVAL_HOURS'] = 24
+app.config['USAGE_ARCHIVE_BATCH_SIZE'] = 1000  # 1 トランザクションで移動する件数
+
+# 店舗ごとのデータベース設定
+# /stores/<店舗キー>/ で始まる URL、または STORE_DOMAIN のサブドメインで店舗を切り替える
+app.config['STORE_DATABASE_DIR'] = os.path.join(app.instance_path, 'stores')
+app.config['STORE_DOMAIN'] = os.environ.get('STORE_DOMAIN')
+app.config['STORE_ENGINE_CACHE_SIZE'] = 32  # 同時に開いておく店舗データベースの最大数
+app.config['STORE_REPORT_WORKERS'] = 8  # 全店舗集計の並列数
+
+# バックグラウンドジョブの設定
+app.config['JOB_WORKERS'] = 2  # 同時に実行するジョブの数
+app.config['JOB_CHUNK_SIZE'] = 200  # 1 トランザクションで処理する件数
+app.config['JOB_HEARTBEAT_SECONDS'] = 10  # 実行中・待機中のジョブの生存を記録する間隔
+app.config['JOB_STALE_SECONDS'] = 60  # この時間生存の記録がないジョブは中断されたとみなす
+
+# 一覧・集計ページ用の読み取り専用データベース（未設定の場合は既定のデータベースを mode=ro で開く）
+app.config['REPORTING_DATABASE_URI'] = os.environ.get('REPORTING_DATABASE_URI')
+
+
+# 選択中の店舗や読み取り専用ルートに応じてデータベースを切り替えるセッション
+class StoreSession(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and has_app_context():
+            store = g.get('store')
+            read_only = g.get('read_only', False)
+            if store or read_only:
+                # 処理中に LRU から外されても同じエンジン（接続）を使い続けるよう、g に固定する
+                engines = g.setdefault('engines', {})
+                key = (store, read_only)
+                if key not in engines:
+                    engines[key] = store_engines.get(store, read_only=read_only)
+                return engines[key]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+db = SQLAlchemy(app, session_options={'class_': StoreSession})
 migrate = Migrate(app, db)
 
 # タイムゾーンの設定
@@ -36,6 +95,10 @@ class Material(db.Model):
     purchase_date = db.Column(db.Date, nullable=True)
     purchase_price = db.Column(db.Float, nullable=False, default=0.0)
     supplier_contact_or_notes = db.Column(db.String(100), nullable=True)
+    # 使用状況の集計値（使用・レシピ更新時に同じトランザクションで更新する）
+    total_used = db.Column(db.Integer, nullable=False, default=0, index=True)
+    last_used_at = db.Column(db.DateTime, nullable=True, index=True)
+    recipe_count = db.Column(db.Integer, nullable=False, default=0, index=True)
 
 
     def __repr__(self):
@@ -45,13 +108,25 @@ class Usage(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     material_id = db.Column(db.Integer, db.ForeignKey('material.id'), nullable=False)
     quantity_used = db.Column(db.Integer, nullable=False)
-    usage_date = db.Column(db.DateTime, default=datetime.utcnow)
+    usage_date = db.Column(db.DateTime, default=datetime.utcnow, index=True)
 
     material = db.relationship('Material', backref=db.backref('usages', lazy=True))
 
     def __repr__(self):
         return f'<Usage {self.quantity_used} of Material ID {self.material_id}>'
 
+# 古い使用履歴の保管先
+class UsageArchive(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    material_id = db.Column(db.Integer, db.ForeignKey('material.id'), nullable=False)
+    quantity_used = db.Column(db.Integer, nullable=False)
+    usage_date = db.Column(db.DateTime, index=True)
+
+    material = db.relationship('Material', backref=db.backref('archived_usages', lazy=True))
+
+    def __repr__(self):
+        return f'<UsageArchive {self.quantity_used} of Material ID {self.material_id}>'
+
 # Recipeモデルの定義
 class Recipe(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -74,25 +149,697 @@ class RecipeMaterial(db.Model):
     recipe = db.relationship('Recipe', backref=db.backref('materials', lazy=True))
     material = db.relationship('Material', backref=db.backref('recipes', lazy=True))
 
+# バックグラウンドジョブの状態
+class Job(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending / running / done / failed
+    progress = db.Column(db.Integer, nullable=False, default=0)  # 処理済みの件数
+    total = db.Column(db.Integer, nullable=False, default=0)  # 処理対象の件数
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    owner = db.Column(db.String(100), nullable=True)  # ジョブを実行するプロセス（ホスト名:pid）
+    heartbeat_at = db.Column(db.DateTime, nullable=True)  # owner のプロセスが最後に生存を記録した日時
+
+    def is_stale(self):
+        # 未完了なのに owner のプロセスから一定時間生存の記録がない
+        if self.status not in ('pending', 'running'):
+            return False
+        limit = datetime.utcnow() - timedelta(seconds=app.config['JOB_STALE_SECONDS'])
+        return self.heartbeat_at is None or self.heartbeat_at < limit
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'progress': self.progress,
+            'total': self.total,
+            'error': self.error,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+            'owner': self.owner,
+            'heartbeat_at': self.heartbeat_at.isoformat() if self.heartbeat_at else None,
+        }
+
+    def __repr__(self):
+        return f'<Job {self.id} {self.kind} {self.status}>'
+
 migrate = Migrate(app, db)
 
+
+# 店舗ごとのデータベースエンジンを管理する（最近使ったものだけ開いておく）
+class StoreEngineRegistry:
+    key_pattern = re.compile(r'^[A-Za-z0-9_-]+$')
+
+    def __init__(self, app):
+        self.app = app
+        self._engines = OrderedDict()
+        self._lock = threading.Lock()
+        self._prepared = set()  # このプロセスでスキーマ更新を済ませた店舗
+        self._prepare_locks = {}
+
+    def path(self, store):
+        if not self.key_pattern.match(store):
+            raise LookupError(f"不正な店舗キーです: {store}")
+        return os.path.join(self.app.config['STORE_DATABASE_DIR'], f'{store}.db')
+
+    def exists(self, store):
+        try:
+            return os.path.exists(self.path(store))
+        except LookupError:
+            return False
+
+    def stores(self):
+        directory = self.app.config['STORE_DATABASE_DIR']
+        if not os.path.isdir(directory):
+            return []
+        return sorted(name[:-3] for name in os.listdir(directory) if name.endswith('.db'))
+
+    def get(self, store, create=False, read_only=False):
+        # 店舗のエンジンを返す。create=False で存在しない店舗の場合は LookupError
+        # store=None, read_only=True の場合は既定のデータベースの読み取り専用エンジンを返す
+        key = (store, read_only)
+        with self._lock:
+            engine = self._engines.get(key)
+            if engine is not None:
+                self._engines.move_to_end(key)
+                return engine
+
+        # マイグレーションなど時間のかかる処理は全体のロックの外で行う
+        if store is None:
+            url = self.app.config['REPORTING_DATABASE_URI'] or self.read_only_url(db.engine.url.database)
+            engine = db.create_engine(url)
+        else:
+            path = self.path(store)
+            if not create and not os.path.exists(path):
+                raise LookupError(f"店舗が見つかりません: {store}")
+            self._prepare(store, path)
+            if read_only:
+                engine = db.create_engine(self.read_only_url(path))
+            else:
+                engine = db.create_engine(f'sqlite:///{path}')
+
+        with self._lock:
+            existing = self._engines.get(key)
+            if existing is not None:
+                # 別のスレッドが先に登録していた場合はそちらを使う
+                engine.dispose()
+                self._engines.move_to_end(key)
+                return existing
+            self._engines[key] = engine
+            while len(self._engines) > self.app.config['STORE_ENGINE_CACHE_SIZE']:
+                _, evicted = self._engines.popitem(last=False)
+                evicted.dispose()
+            return engine
+
+    def _prepare(self, store, path):
+        # 店舗ごとのロックで、同じ店舗のスキーマ更新が重ならないようにする
+        if store in self._prepared:
+            return
+        with self._lock:
+            prepare_lock = self._prepare_locks.setdefault(store, threading.Lock())
+        with prepare_lock:
+            if store in self._prepared:
+                return
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            upgrade_store_database(path)
+            self._prepared.add(store)
+
+    @staticmethod
+    def read_only_url(path):
+        return f'sqlite:///file:{path}?mode=ro&uri=true'
+
+
+store_engines = StoreEngineRegistry(app)
+
+
+# alembic_version を持たない店舗データベースのリビジョン
+# （店舗データベースは usage_archive の追加後に導入され、db.create_all() で作成されていた）
+STORE_BASE_REVISION = '5d2c8a41e9b3'
+STORE_COUNTERS_REVISION = 'a3e7f19c2d84'  # material に集計値の列がある場合
+
+
+# Alembic は実行中の状態をモジュール変数に持つため、同時に 1 つずつしか実行できない
+# （エンジンの登録簿のロックとは別なので、作成済みのエンジンの取得は待たされない）
+alembic_lock = threading.Lock()
+
+
+def upgrade_store_database(path):
+    # 店舗データベースを最新のマイグレーションまで更新する
+    engine = db.create_engine(f'sqlite:///{path}')
+    try:
+        with alembic_lock, engine.begin() as connection:
+            config = migrate.get_config(os.path.join(app.root_path, 'migrations'))
+            config.attributes['connection'] = connection
+            inspector = db.inspect(connection)
+            if not inspector.has_table('material'):
+                # 新しい店舗はモデルからテーブルを作成し、最新のリビジョンとして記録する
+                db.metadata.create_all(connection)
+                alembic_command.stamp(config, 'head')
+                return
+            if not inspector.has_table('alembic_version'):
+                columns = [column['name'] for column in inspector.get_columns('material')]
+                alembic_command.stamp(config, STORE_COUNTERS_REVISION if 'total_used' in columns else STORE_BASE_REVISION)
+            alembic_command.upgrade(config, 'head')
+    finally:
+        engine.dispose()
+
+
+def read_only(view):
+    # 参照のみのルートを読み取り専用エンジンに振り分ける（書き込みは既定のエンジンのまま）
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        g.read_only = True
+        return view(*args, **kwargs)
+    return wrapper
+
+
+# URL の /stores/<店舗キー>/ またはサブドメインから店舗キーを取り出す
+class StoreDispatcher:
+    prefix_pattern = re.compile(r'^/stores/([A-Za-z0-9_-]+)(?=/|$)')
+
+    def __init__(self, wsgi_app, app):
+        self.wsgi_app = wsgi_app
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        store = None
+        path = environ.get('PATH_INFO', '')
+        match = self.prefix_pattern.match(path)
+        if match:
+            store = match.group(1)
+            # SCRIPT_NAME に含めることで url_for が店舗のプレフィックス付き URL を生成する
+            environ['SCRIPT_NAME'] = environ.get('SCRIPT_NAME', '') + match.group(0)
+            environ['PATH_INFO'] = path[match.end():] or '/'
+        elif self.app.config['STORE_DOMAIN']:
+            host = environ.get('HTTP_HOST', '').split(':')[0]
+            suffix = '.' + self.app.config['STORE_DOMAIN']
+            if host.endswith(suffix):
+                store = host[:-len(suffix)]
+        environ['store'] = store
+        return self.wsgi_app(environ, start_response)
+
+
+app.wsgi_app = StoreDispatcher(app.wsgi_app, app)
+
+
+@app.template_global()
+def store_url(store):
+    # 店舗のトップページの URL（店舗を選択していないページから呼ばれる）
+    return f'{request.script_root}/stores/{store}/'
+
+
+@app.before_request
+def select_store():
+    g.store = request.environ.get('store')
+    if g.store and not store_engines.exists(g.store):
+        abort(404)
+
+
+@app.cli.command('create-store')
+@click.argument('store')
+def create_store_command(store):
+    store_engines.get(store, create=True)
+    click.echo(f'店舗 {store} のデータベースを作成しました')
+
+
+@app.cli.command('upgrade-stores')
+def upgrade_stores_command():
+    # すべての店舗データベースを最新のマイグレーションまで更新する
+    for store in store_engines.stores():
+        upgrade_store_database(store_engines.path(store))
+        click.echo(f'店舗 {store} のデータベースを更新しました')
+
+
+# flush がキューに入れる目印。ok は目印より前の分がすべて書き込めたかどうか
+class FlushMarker:
+    def __init__(self):
+        self.done = threading.Event()
+        self.ok = False
+
+
+# 使用履歴のバックグラウンド書き込み
+class UsageWriter:
+    def __init__(self, app):
+        self.app = app
+        self.batch_size = app.config['USAGE_BATCH_SIZE']
+        self.flush_interval = app.config['USAGE_FLUSH_INTERVAL_MS'] / 1000
+        self.queue = queue.Queue(maxsize=app.config['USAGE_QUEUE_MAXSIZE'])
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._failed = []  # 書き込みに失敗し、再試行を待っている分
+
+    def put(self, store, row):
+        # キューが満杯のまま待ち時間を過ぎた場合は False を返す
+        if self._thread is None:
+            self.start()
+        if len(self._failed) >= self.queue.maxsize:
+            # 再試行待ちが溜まっている間は呼び出し側で同期的に書き込ませる
+            return False
+        try:
+            self.queue.put((store, row), timeout=self.flush_interval)
+            return True
+        except queue.Full:
+            return False
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='usage-writer', daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        # 終了時にキューに残っている分をすべて書き込む
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._drain()
+        if self._failed:
+            self.app.logger.error("使用履歴を書き込めないまま終了します: %s", self._failed)
+
+    def flush(self):
+        # 呼び出し時点までにキューに入っていた分の書き込みを待つ
+        # 書き込みに失敗して再試行待ちの分が残っている場合は False を返す
+        if self._thread is None:
+            return True
+        marker = FlushMarker()
+        self.queue.put(marker)
+        while not marker.done.wait(self.flush_interval):
+            if not self._thread.is_alive():
+                # ライタースレッドが停止済みの場合はこのスレッドで書き込む
+                self._drain()
+        return marker.ok
+
+    def _drain(self):
+        with self._write_lock:
+            while True:
+                items = self._take(block=False)
+                if not items:
+                    break
+                self._process(items)
+
+    def _take(self, block):
+        # 最大 batch_size 件を取り出す。flush の目印を取り出した時点で打ち切る
+        items = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(items) < self.batch_size:
+            try:
+                if block:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    items.append(self.queue.get(timeout=remaining))
+                else:
+                    items.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+            if isinstance(items[-1], FlushMarker):
+                break
+        return items
+
+    def _process(self, items):
+        rows = []
+        for item in items:
+            if isinstance(item, FlushMarker):
+                # 目印より前の分を書き込んでから flush の待ちを解除する
+                self._write(rows)
+                rows = []
+                item.ok = not self._failed
+                item.done.set()
+            else:
+                rows.append(item)
+        self._write(rows)
+
+    def _write(self, items):
+        # 店舗ごとにまとめて書き込む。前回失敗した分もここで再試行する
+        batches = {}
+        for store, row in self._failed + items:
+            batches.setdefault(store, []).append(row)
+        self._failed = []
+        for store, rows in batches.items():
+            if not self._write_batch(store, rows):
+                self._failed.extend((store, row) for row in rows)
+
+    def _write_batch(self, store, rows):
+        for attempt in range(3):
+            try:
+                with self.app.app_context():
+                    engine = store_engines.get(store) if store else db.engine
+                    with engine.begin() as conn:
+                        conn.execute(Usage.__table__.insert(), rows)
+                return True
+            except Exception:
+                if attempt == 2:
+                    self.app.logger.exception("使用履歴の書き込みに失敗しました。後で再試行します (店舗: %s, %d 件)", store, len(rows))
+                else:
+                    time.sleep(self.flush_interval)
+        return False
+
+    def _run(self):
+        while not self._stop.is_set():
+            items = self._take(block=True)
+            if items or self._failed:
+                with self._write_lock:
+                    self._process(items)
+
+
+usage_writer = UsageWriter(app)
+atexit.register(usage_writer.stop)
+
+
+def record_usage(material_id, quantity_used, usage_date):
+    # 在庫の減算と同じリクエストで使用履歴を記録してコミットする
+    usage = {'material_id': material_id, 'quantity_used': quantity_used, 'usage_date': usage_date}
+    if app.config['USAGE_DURABILITY'] == 'batched':
+        db.session.commit()
+        if usage_writer.put(g.get('store'), usage):
+            return
+        # キューが満杯の場合は同期的に書き込む
+    db.session.add(Usage(**usage))
+    db.session.commit()
+
+
+def adjust_recipe_count(material_ids, delta):
+    # レシピで使われている素材の recipe_count を増減する（コミットは呼び出し側で行う）
+    material_ids = set(material_ids)
+    if material_ids:
+        db.session.execute(
+            db.update(Material)
+            .where(Material.id.in_(material_ids))
+            .values(recipe_count=Material.recipe_count + delta)
+        )
+
+
+def expected_material_counters():
+    # 使用履歴とレシピから計算した集計値（素材の行ごとの相関サブクエリ）
+    def usage_total(model):
+        return (
+            db.select(db.func.coalesce(db.func.sum(model.quantity_used), 0))
+            .where(model.material_id == Material.id)
+            .scalar_subquery()
+        )
+
+    def last_usage(model):
+        return db.select(db.func.max(model.usage_date)).where(model.material_id == Material.id).scalar_subquery()
+
+    hot_last, archived_last = last_usage(Usage), last_usage(UsageArchive)
+    return {
+        'total_used': usage_total(Usage) + usage_total(UsageArchive),
+        # SQLite の max(a, b) は NULL を含むと NULL になるため、片方が NULL の場合はもう片方を使う
+        'last_used_at': db.func.max(db.func.coalesce(hot_last, archived_last), db.func.coalesce(archived_last, hot_last)),
+        'recipe_count': (
+            db.select(db.func.count(db.distinct(RecipeMaterial.recipe_id)))
+            .where(RecipeMaterial.material_id == Material.id)
+            .scalar_subquery()
+        ),
+    }
+
+
+def repair_material_counters(fix=True, first_id=None, last_id=None):
+    # 集計値を 1 つの UPDATE で再計算し、食い違っていた素材の数を返す
+    # first_id / last_id で素材 id の範囲を絞れる（コミットは呼び出し側で行う）
+    # 使用履歴をまとめて書き込むモードでは、集計値は先にコミットされ使用履歴はキューに残るため、
+    # 使用履歴から計算し直すと値を小さく上書きしてしまう。そのため修正は同期モードでのみ行う。
+    # 検査（fix=False）もライターが書き込み待ちを持たないときだけ正確になる
+    if fix and app.config['USAGE_DURABILITY'] == 'batched':
+        raise RuntimeError("USAGE_DURABILITY=batched の間は集計値を修正できません")
+    expected = expected_material_counters()
+    conditions = [db.or_(*[getattr(Material, name).is_distinct_from(value) for name, value in expected.items()])]
+    if first_id is not None:
+        conditions.append(Material.id >= first_id)
+    if last_id is not None:
+        conditions.append(Material.id <= last_id)
+    if not fix:
+        return db.session.query(db.func.count(Material.id)).filter(*conditions).scalar()
+    result = db.session.execute(
+        db.update(Material).where(*conditions).values(**expected),
+        execution_options={'synchronize_session': False}
+    )
+    return result.rowcount
+
+
+@app.cli.command('repair-material-counters')
+@click.option('--check', is_flag=True, help='修正せずに食い違いの件数だけ表示する')
+@click.option('--store', default=None, help='対象の店舗キー（省略時は既定のデータベース）')
+def repair_material_counters_command(check, store):
+    # 実行中のアプリが使用履歴を書き込み待ちにしていない（同期モードか停止中の）ときに実行する
+    g.store = store
+    try:
+        count = repair_material_counters(fix=not check)
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+    db.session.commit()
+    if check:
+        click.echo(f'{count} 件の素材の集計値が食い違っています')
+    else:
+        click.echo(f'{count} 件の素材の集計値を修正しました')
+
+
+# 使用履歴のアーカイブ
+def archive_usage(cutoff):
+    # cutoff より古い使用履歴をアーカイブテーブルへ移動し、移動した件数を返す
+    # 書き込みを長時間止めないよう、id の範囲ごとに分けてコミットする
+    if not usage_writer.flush():
+        raise RuntimeError("書き込めていない使用履歴があるため、アーカイブを中止しました")
+    # SQLite は削除された最大の id を再利用するため、アーカイブ側では新しい id を振る
+    columns = ['material_id', 'quantity_used', 'usage_date']
+    batch_size = app.config['USAGE_ARCHIVE_BATCH_SIZE']
+    moved = 0
+    last_id = 0
+    while True:
+        ids = db.session.execute(
+            db.select(Usage.id)
+            .where(Usage.usage_date < cutoff, Usage.id > last_id)
+            .order_by(Usage.id)
+            .limit(batch_size)
+        ).scalars().all()
+        if not ids:
+            break
+        in_batch = db.and_(Usage.usage_date < cutoff, Usage.id.between(ids[0], ids[-1]))
+        old_usages = db.select(Usage.material_id, Usage.quantity_used, Usage.usage_date).where(in_batch)
+        try:
+            db.session.execute(db.insert(UsageArchive).from_select(columns, old_usages))
+            result = db.session.execute(db.delete(Usage).where(in_batch))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        moved += result.rowcount
+        last_id = ids[-1]
+    return moved
+
+
+def archived_until():
+    # アーカイブ済みの最新の使用日時（アーカイブが空なら None）
+    return db.session.query(db.func.max(UsageArchive.usage_date)).scalar()
+
+
+@app.cli.command('archive-usage')
+@click.option('--days', default=365, show_default=True, help='この日数より古い使用履歴をアーカイブする')
+@click.option('--store', default=None, help='対象の店舗キー（省略時は既定のデータベース）')
+def archive_usage_command(days, store):
+    g.store = store
+    count = archive_usage(datetime.utcnow() - timedelta(days=days))
+    click.echo(f'{count} 件の使用履歴をアーカイブしました')
+
+
+archive_scheduler_lock = threading.Lock()
+archive_scheduler_started = False
+
+
+@app.before_request
+def start_archive_scheduler():
+    # USAGE_ARCHIVE_DAYS が設定されている場合、定期的にアーカイブを実行する
+    # （リローダーの親プロセスや CLI では開始しないよう、最初のリクエスト時に開始する）
+    global archive_scheduler_started
+    days = app.config['USAGE_ARCHIVE_DAYS']
+    if not days or archive_scheduler_started:
+        return
+    with archive_scheduler_lock:
+        if archive_scheduler_started:
+            return
+        archive_scheduler_started = True
+    interval = app.config['USAGE_ARCHIVE_INTERVAL_HOURS'] * 3600
+
+    def run():
+        while True:
+            for store in [None] + store_engines.stores():
+                try:
+                    with app.app_context():
+                        g.store = store
+                        archive_usage(datetime.utcnow() - timedelta(days=days))
+                except Exception:
+                    app.logger.exception("使用履歴のアーカイブに失敗しました (店舗: %s)", store)
+            time.sleep(interval)
+
+    threading.Thread(target=run, name='usage-archiver', daemon=True).start()
+
+
+# バックグラウンドジョブ
+job_tasks = {}
+# 通常の終了時は、キューに残っているジョブも実行し終えてから終了する
+job_executor = ThreadPoolExecutor(max_workers=app.config['JOB_WORKERS'], thread_name_prefix='job')
+
+
+active_jobs = set()  # このプロセスが受け付けた未完了のジョブ (店舗, id)
+active_jobs_lock = threading.Lock()
+job_heartbeat_thread = None
+
+
+def job_owner():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def start_job_heartbeat():
+    # このプロセスの未完了のジョブについて、定期的に heartbeat_at を更新する
+    global job_heartbeat_thread
+    with active_jobs_lock:
+        if job_heartbeat_thread is not None:
+            return
+        job_heartbeat_thread = threading.Thread(target=run_job_heartbeat, name='job-heartbeat', daemon=True)
+        job_heartbeat_thread.start()
+
+
+def run_job_heartbeat():
+    while True:
+        time.sleep(app.config['JOB_HEARTBEAT_SECONDS'])
+        with active_jobs_lock:
+            jobs = list(active_jobs)
+        by_store = {}
+        for store, job_id in jobs:
+            by_store.setdefault(store, []).append(job_id)
+        for store, job_ids in by_store.items():
+            try:
+                with app.app_context():
+                    g.store = store
+                    db.session.execute(
+                        db.update(Job).where(Job.id.in_(job_ids)).values(heartbeat_at=datetime.utcnow()),
+                        execution_options={'synchronize_session': False}
+                    )
+                    db.session.commit()
+            except Exception:
+                app.logger.exception("ジョブの生存の記録に失敗しました (店舗: %s)", store)
+
+
+def job_task(kind):
+    # ジョブとして実行できる処理を登録する
+    def decorator(func):
+        job_tasks[kind] = func
+        return func
+    return decorator
+
+
+def submit_job(kind):
+    job = Job(kind=kind, owner=job_owner(), heartbeat_at=datetime.utcnow())
+    db.session.add(job)
+    db.session.commit()
+    with active_jobs_lock:
+        active_jobs.add((g.get('store'), job.id))
+    start_job_heartbeat()
+    job_executor.submit(run_job, g.get('store'), job.id)
+    return job
+
+
+def run_job(store, job_id):
+    try:
+        with app.app_context():
+            g.store = store
+            job = db.session.get(Job, job_id)
+            job.status = 'running'
+            job.heartbeat_at = datetime.utcnow()
+            db.session.commit()
+            try:
+                job_tasks[job.kind](job)
+                job.status = 'done'
+                job.error = None
+            except Exception as e:
+                app.logger.exception("ジョブの実行に失敗しました: %s", job_id)
+                db.session.rollback()
+                job = db.session.get(Job, job_id)
+                job.status = 'failed'
+                job.error = str(e)
+            job.finished_at = datetime.utcnow()
+            db.session.commit()
+    finally:
+        with active_jobs_lock:
+            active_jobs.discard((store, job_id))
+
+
+@job_task('reprice_recipes')
+def reprice_recipes(job):
+    # 現在の素材単価で全レシピの原価合計と原価率を再計算する
+    chunk_size = app.config['JOB_CHUNK_SIZE']
+    job.total = Recipe.query.count()
+    db.session.commit()
+    last_id = 0
+    while True:
+        recipes = (
+            Recipe.query.options(db.selectinload(Recipe.materials).joinedload(RecipeMaterial.material))
+            .filter(Recipe.id > last_id)
+            .order_by(Recipe.id)
+            .limit(chunk_size)
+            .all()
+        )
+        if not recipes:
+            break
+        for recipe in recipes:
+            total_material_cost = sum(rm.quantity_used * rm.material.unit_price for rm in recipe.materials if rm.material)
+            recipe.total_cost = total_material_cost + recipe.labor_cost
+            recipe.profit_margin = (recipe.total_cost / recipe.listing_price * 100) if recipe.listing_price > 0 else 0
+        # 進捗も同じトランザクションでコミットする
+        job.progress += len(recipes)
+        db.session.commit()
+        last_id = recipes[-1].id
+
+
+@job_task('repair_material_counters')
+def repair_material_counters_job(job):
+    # 素材の集計値を id の範囲ごとに再計算する（同期モードでのみ実行できる）
+    if app.config['USAGE_DURABILITY'] == 'batched':
+        raise RuntimeError("USAGE_DURABILITY=batched の間は集計値を修正できません")
+    chunk_size = app.config['JOB_CHUNK_SIZE']
+    job.total = Material.query.count()
+    db.session.commit()
+    last_id = 0
+    while True:
+        ids = db.session.execute(
+            db.select(Material.id).where(Material.id > last_id).order_by(Material.id).limit(chunk_size)
+        ).scalars().all()
+        if not ids:
+            break
+        repair_material_counters(first_id=ids[0], last_id=ids[-1])
+        # 進捗も同じトランザクションでコミットする
+        job.progress += len(ids)
+        db.session.commit()
+        last_id = ids[-1]
+
+
 with app.app_context():
     db.create_all()
 
 # 素材一覧表示
 @app.route('/')
+@read_only
 def index():
     search_query = request.args.get('search')
+    query = Material.query
     if search_query:
-        materials = Material.query.filter(
+        query = query.filter(
             db.or_(
                 Material.name.contains(search_query),
                 Material.category.contains(search_query),
                 Material.supplier.contains(search_query)
             )
-        ).all()
-    else:
-        materials = Material.query.all()
+        )
+    # 集計値の列で並び替え（インデックスがあるので全件集計は不要）
+    sort = request.args.get('sort')
+    if sort in ('total_used', 'last_used_at', 'recipe_count'):
+        query = query.order_by(getattr(Material, sort).desc())
+    materials = query.all()
     
     return render_template('index.html', materials=materials)
 
@@ -201,22 +948,79 @@ def use_material(id):
     material = Material.query.get_or_404(id)
     if request.method == 'POST':
         quantity_used = int(request.form['quantity_used'])
-        if material.quantity >= quantity_used:
-            material.quantity -= quantity_used
-            usage = Usage(material_id=id, quantity_used=quantity_used)
-            db.session.add(usage)
-            db.session.commit()
+        usage_date = datetime.utcnow()
+        # 条件付き UPDATE で在庫を減らし、同時に使用されてもマイナスにならないようにする
+        result = db.session.execute(
+            db.update(Material)
+            .where(Material.id == id, Material.quantity >= quantity_used)
+            .values(
+                quantity=Material.quantity - quantity_used,
+                total_used=Material.total_used + quantity_used,
+                last_used_at=usage_date
+            )
+        )
+        if result.rowcount == 1:
+            record_usage(id, quantity_used, usage_date)
             return redirect(url_for('index'))
         else:
+            db.session.rollback()
             return f"Not enough material in stock. Available quantity: {material.quantity}", 400
     return render_template('use_material.html', material=material)
 
 
 # 使用履歴一覧
 @app.route('/usage_history')
+@read_only
 def usage_history():
-    usages = Usage.query.all()
-    return render_template('usage_history.html', usages=usages)
+    saved = usage_writer.flush()
+    start = request.args.get('start')
+    end = request.args.get('end')
+    try:
+        start = datetime.strptime(start, '%Y-%m-%d') if start else None
+        end = datetime.strptime(end, '%Y-%m-%d') + timedelta(days=1) if end else None
+    except ValueError as ve:
+        return f"Invalid date provided: {ve}", 400
+
+    def in_range(query, model):
+        if start:
+            query = query.filter(model.usage_date >= start)
+        if end:
+            query = query.filter(model.usage_date < end)
+        return query.order_by(model.usage_date)
+
+    usages = in_range(Usage.query, Usage).all()
+    # 期間の指定がない場合はアーカイブされていない分だけを表示し（アーカイブ済みである旨を案内する）、
+    # 指定期間がアーカイブ済みの範囲にかかる場合のみアーカイブも読む
+    until = archived_until()
+    include_archive = until is not None and (start or end) and (start is None or start <= until)
+    if include_archive:
+        archived = in_range(UsageArchive.query, UsageArchive).all()
+        usages = archived + usages
+    return render_template('usage_history.html', usages=usages, archived_until=until if not (start or end) else None, unsaved=not saved)
+
+# 店舗ごとの集計（スレッドプールから呼ばれる）
+def store_summary(store):
+    with app.app_context():
+        g.store = store
+        g.read_only = True
+        return {
+            'store': store,
+            'material_count': Material.query.count(),
+            'stock_value': db.session.query(db.func.coalesce(db.func.sum(Material.quantity * Material.unit_price), 0)).scalar(),
+            'recipe_count': Recipe.query.count(),
+        }
+
+
+# 全店舗の集計
+@app.route('/store_report')
+@read_only
+def store_report():
+    # 全店舗をまたぐページなので、店舗の URL の下では表示しない
+    if g.store:
+        abort(404)
+    with ThreadPoolExecutor(max_workers=app.config['STORE_REPORT_WORKERS']) as executor:
+        summaries = list(executor.map(store_summary, store_engines.stores()))
+    return render_template('store_report.html', summaries=summaries)
 
 # 素材削除
 @app.route('/delete/<int:id>')
@@ -387,6 +1191,7 @@ def new_recipe():
             new_recipe.profit_margin = profit_margin
 
             db.session.add_all(material_entries)
+            adjust_recipe_count([entry.material_id for entry in material_entries], 1)
             db.session.commit()
 
             return redirect(url_for('index'))
@@ -397,6 +1202,7 @@ def new_recipe():
         return render_template('new.html', materials=materials_data, categories=[c[0] for c in categories])
 
 @app.route('/recipes', methods=['GET'])
+@read_only
 def recipe_list():
     recipes = Recipe.query.all()
     recipe_data = []
@@ -422,6 +1228,7 @@ def recipe_list():
 def delete_recipe(recipe_id):
     recipe = Recipe.query.get_or_404(recipe_id)
     # レシピに関連する素材の削除
+    adjust_recipe_count([rm.material_id for rm in RecipeMaterial.query.filter_by(recipe_id=recipe_id)], -1)
     RecipeMaterial.query.filter_by(recipe_id=recipe_id).delete()
     
     db.session.delete(recipe)
@@ -429,6 +1236,7 @@ def delete_recipe(recipe_id):
     return redirect(url_for('recipe_list'))
 
 @app.route('/recipe_detail/<int:recipe_id>')
+@read_only
 def recipe_detail(recipe_id):
     recipe = Recipe.query.get_or_404(recipe_id)
     materials = RecipeMaterial.query.filter_by(recipe_id=recipe_id).all()
@@ -451,12 +1259,14 @@ def edit_recipe(recipe_id):
         recipe.listing_price = float(request.form['listing_price'])
 
         # 現在のレシピに関連する素材の削除
+        adjust_recipe_count([rm.material_id for rm in RecipeMaterial.query.filter_by(recipe_id=recipe.id)], -1)
         RecipeMaterial.query.filter_by(recipe_id=recipe.id).delete()
         db.session.flush()
 
         # 新しい素材情報の保存
         material_names = request.form.getlist('material_name')
         quantities_used = request.form.getlist('quantity_used')
+        new_material_ids = []
 
         for i in range(len(material_names)):
             material_name = material_names[i]
@@ -471,7 +1281,9 @@ def edit_recipe(recipe_id):
                         quantity_used=int(quantity_used)
                     )
                     db.session.add(material_entry)
+                    new_material_ids.append(material.id)
 
+        adjust_recipe_count(new_material_ids, 1)
         db.session.commit()
         return redirect(url_for('recipe_list'))
 
@@ -504,5 +1316,27 @@ def edit_recipe(recipe_id):
     return render_template('edit_recipe.html', recipe=recipe, materials=materials_data, categories=[c[0] for c in categories], form_data=form_data)
 
 
+# ジョブの登録
+@app.route('/jobs/<kind>', methods=['POST'])
+def create_job(kind):
+    if kind not in job_tasks:
+        abort(404)
+    job = submit_job(kind)
+    return jsonify(job.to_dict()), 202, {'Location': url_for('job_status', job_id=job.id)}
+
+
+# ジョブの進捗確認（登録直後でも見つかるよう、レプリカではなく既定のデータベースから読む）
+@app.route('/jobs/<int:job_id>')
+def job_status(job_id):
+    job = Job.query.get_or_404(job_id)
+    # 強制終了などで owner のプロセスがいなくなったジョブは失敗にする
+    if job.is_stale():
+        job.status = 'failed'
+        job.error = 'interrupted'
+        job.finished_at = datetime.utcnow()
+        db.session.commit()
+    return jsonify(job.to_dict())
+
+
 if __name__ == '__main__':
     app.run(debug=True, port=5001)